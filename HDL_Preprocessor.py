@@ -16,11 +16,29 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.                                              #
 #######################################################################################################################
 
-import datetime
 import os
 import re
 import sublime
 import sublime_plugin
+import time
+
+# Precompiled preprocessor patterns
+# Backticks which don't start a supported directive (macro usages, `timescale, ...) are not matched at all
+_TOKEN_RE = re.compile(
+    rb'(?P<line_comment>\/\/)|'
+    rb'(?P<block_comment>\/\*)|'
+    rb'(?P<string>")|'
+    rb'`(?:'
+    rb'(?P<include>include\s+"(?P<include_name>[^"]+)")|'
+    rb'(?P<define>define\s+(?P<define_name>[a-zA-Z_][a-zA-Z0-9_$]*))|'
+    rb'(?P<undef>undef\s+(?P<undef_name>[a-zA-Z_][a-zA-Z0-9_$]*))|'
+    rb'(?P<resetall>resetall)(?=[^a-zA-Z0-9_$])|'
+    rb'(?P<ifdef>ifdef\s+(?P<ifdef_name>[a-zA-Z_][a-zA-Z0-9_$]*))|'
+    rb'(?P<else>else)(?=[^a-zA-Z0-9_$])|'
+    rb'(?P<endif>endif)(?=[^a-zA-Z0-9_$])|'
+    rb'(?P<ifndef>ifndef\s+(?P<ifndef_name>[a-zA-Z_][a-zA-Z0-9_$]*))'
+    rb')'
+)
 
 class SublimeModified(sublime_plugin.EventListener):
 
@@ -32,24 +50,30 @@ class SublimeModified(sublime_plugin.EventListener):
         :type view: sublime.View
         '''
         # Update current status
-        HDL_Preprocessor.modified_time = datetime.datetime.now().timestamp()
+        HDL_Preprocessor.modified_time = time.monotonic()
         HDL_Preprocessor.modified_view = view
         # Get settings
         settings.reload(view)
         delay = settings.delay()
         # Track modifications
-        sublime.set_timeout_async(HDL_Preprocessor.track_modifications, 1050 * delay)
+        HDL_Preprocessor.schedule_track_modifications(1.05 * delay)
 
 class HDL_Preprocessor:
     '''Verilog and SystemVerilog preprocessor with Sublime Text 4
     '''
 
+    _include_cache = {}  # Included file path -> (file key, {preprocessor state: preprocessor result})
+    _resolve_cache = {}  # (Including directory, Include name) -> Included file path
+
     def __init__(self):
         '''Initialization
         '''
-        self.modified_time = datetime.datetime.now().timestamp()  # Time of last modification
-        self.compiled_time = datetime.datetime.now().timestamp()  # Time of last compilation
+        self.modified_time = time.monotonic()  # Time of last modification
+        self.compiled_time = time.monotonic()  # Time of last compilation
         self.modified_view = None  # Last modified view
+        self.timer_pending = False  # Modifications tracking is scheduled
+        self.compiled_change = None  # Buffer id and change count of last compilation
+        self.resolve_incdirs = None  # `incdirs` used to resolve cached include paths
 
     def get_os_path(self, view):
         '''Returns some useful data on pathnames
@@ -66,207 +90,357 @@ class HDL_Preprocessor:
             head, tail = os.path.split(file_name)
         return head, tail, ext
 
+    def schedule_track_modifications(self, timeout):
+        '''Schedule modifications tracking unless it is already pending
+
+        :param timeout: Time in seconds after which modifications are tracked
+        :type timeout: int or float
+        '''
+        if not self.timer_pending:
+            self.timer_pending = True
+            sublime.set_timeout_async(self.on_timeout, int(1000 * timeout))
+
+    def on_timeout(self):
+        '''Called after scheduled delay. Track modifications if view was not modified in meantime or schedule it again.
+        '''
+        self.timer_pending = False
+        now = time.monotonic()
+        delay = settings.delay()
+        if (now - self.modified_time) > 0.95 * delay:
+            self.track_modifications()
+        else:
+            self.schedule_track_modifications(max(0, 1.05 * delay - (now - self.modified_time)))
+
     def track_modifications(self):
         '''Check if the content of the file has changed
         '''
         if self.modified_time > self.compiled_time:
-            now = datetime.datetime.now().timestamp()
+            now = time.monotonic()
             view = self.modified_view
             # Get settings
             delay = settings.delay()
             # Check changes
             if (now - self.modified_time) > 0.95 * delay:
                 self.compiled_time = self.modified_time
-                if type(view) == sublime.View:
+                if isinstance(view, sublime.View):
                     head, tail, ext = self.get_os_path(view)
-                    self.head = [head]
-                    if ext in ['.v', '.vh', '.sv', '.svh']:
-                        # Get file content
+                    # Skip buffer which was not changed since last compilation
+                    change = (view.buffer_id(), view.change_count())
+                    if ext in ['.v', '.vh', '.sv', '.svh'] and change != self.compiled_change:
+                        self.compiled_change = change
+                        # Get file content as UTF-8 bytes
                         sublime_region = sublime.Region(0, view.size())
-                        content = view.substr(sublime_region)
-                        self.defines = []
-                        self.conditionals = []
-                        regions = self.preproc(content)
+                        text = view.substr(sublime_region)
+                        content = text.encode('utf-8', errors='replace')
+                        self.defines = set()
+                        self.cond_equal = []
+                        self.cond_exclude = []
+                        self.include_deps = []
+                        regions = self.preproc(content, head)
+                        if len(text) != len(content):
+                            regions = self.get_char_regions(content, regions)
+                        regions = [sublime.Region(start, end) for start, end in regions]
                         view.erase_regions('HDL_Preprocesor')
                         view.add_regions(
                             'HDL_Preprocesor', regions, 'comment', '', sublime.DRAW_EMPTY
                         )
 
-    def preproc(self, content):
+    def preproc(self, content, cur_dir):
         '''Preprocessor file content
 
         :param content: File content
-        :type content: str
-        :return regions
-        :rtype: list of regions
+        :type content: bytes
+        :param cur_dir: Directory of preprocessed file
+        :type cur_dir: str
+        :return regions (offsets in bytes)
+        :rtype: list of (int, int)
         '''
         # Get settings
         incdirs = settings.incdirs()
         # Initialize preprocessor
-        pos = 0
-        match = True
         exclude = False
         exclude_pos_start = 0
         exclude_pos_end = 0
         regions = []
+        # Bind frequently used objects to local names
+        defines = self.defines
+        cond_equal = self.cond_equal
+        cond_exclude = self.cond_exclude
+        add_region = self.add_region
+        content_find = content.find
+        tokens_finditer = _TOKEN_RE.finditer
+        # Skip content without preprocessor directives
+        next_tick = content_find(b'`')
+        if next_tick == -1:
+            return regions
+        # Extract all tokens in a single pass
+        tokens = iter(list(tokens_finditer(content)))
+        pos = 0  # End of last skipped comment or string
         # Search preprocessor directives
-        while pos < len(content):
-            last_pos = pos
-            pattern = re.compile(r'(`|"|\/\/|\/\*)')
-            match = pattern.search(content, pos)
-            if match:
-                match_start = match.start(1)
-                match_end = match.end(1)
-                match_x = match.group(1)
-                # Single line comment
-                if match_x == '//':
-                    pattern = re.compile(r'(\n)')
-                    match = pattern.search(content, match_end)
-                    if match:
-                        pos = match.end(1)
-                    else:
-                        pos = len(content)
-                        print('HDL_Syntax: Signle line comment is not ended with `newline`.')
-                # Multi line comment
-                elif match_x == '/*':
-                    pattern = re.compile(r'(\*\/)')
-                    match = pattern.search(content, match_end)
-                    if match:
-                        pos = match.end(1)
-                    else:
-                        pos = len(content)
-                        print('HDL_Syntax: Multi line comment is not ended with `*/`.')
-                # String
-                elif match_x == '"':
-                    pattern = re.compile(r'(?<!\\)(")')
-                    match = pattern.search(content, match_end)
-                    if match:
-                        pos = match.end(1)
-                    else:
-                        pos = len(content)
-                        print('HDL_Syntax: String is not ended with `"`.')
-                # Preprocessor directive
-                elif match_x == '`':
-                    match = False
-                    # Include
-                    if not match:
-                        pattern = re.compile(r'(`include)\s+"([^"]+)"')
-                        match = pattern.match(content, match_start)
-                        if match:
-                            file_name = os.path.join(self.head[-1], match.group(2))
-                            file_name = os.path.normpath(file_name)
-                            if os.path.isfile(file_name):
-                                try:
-                                    with open(file_name, 'r') as file:
-                                        self.head.append(os.path.split(file_name)[0])
-                                        include_content = file.read()
-                                        self.preproc(include_content)
-                                        del self.head[-1]
-                                except OSError:
-                                    print(f"HDL_Syntax: Can\'t open `{file_name}` file.")
-                            else:
-                                for incdir in incdirs:
-                                    file_name = os.path.join(incdir, match.group(2))
-                                    file_name = os.path.normpath(file_name)
-                                    if os.path.isfile(file_name):
-                                        try:
-                                            with open(file_name, 'r') as file:
-                                                self.head.append(os.path.split(file_name)[0])
-                                                include_content = file.read()
-                                                self.preproc(include_content)
-                                                del self.head[-1]
-                                        except OSError:
-                                            print(f"HDL_Syntax: Can\'t open `{file_name}` file.")
-                                        break
-                            pos = match.end(2) + 1
-                    # Define
-                    if not match:
-                        pattern = re.compile(r'(`define)\s+([a-zA-Z_][a-zA-Z0-9_$]*)')
-                        match = pattern.match(content, match_start)
-                        if match:
-                            if match.group(2) not in self.defines:
-                                self.defines.append(match.group(2))
-                            pos = match.end(2)
-                    # Undefine
-                    if not match:
-                        pattern = re.compile(r'(`undef)\s+([a-zA-Z_][a-zA-Z0-9_$]*)')
-                        match = pattern.match(content, match_start)
-                        if match:
-                            if match.group(2) in self.defines:
-                                self.defines.remove(match.group(2))
-                            pos = match.end(2)
-                    # Reset all defines
-                    if not match:
-                        pattern = re.compile(r'(`resetall)[^a-zA-Z0-9_$]')
-                        match = pattern.match(content, match_start)
-                        if match:
-                            self.defines = []
-                            pos = match.end(1)
-                    # Preprocessor if
-                    if not match:
-                        pattern = re.compile(r'(`ifdef)\s+([a-zA-Z_][a-zA-Z0-9_$]*)')
-                        match = pattern.match(content, match_start)
-                        if match:
-                            self.conditionals.append({
-                                'equal': True if match.group(2) in self.defines else False,
-                                'exclude': True if not exclude and match.group(2) not in self.defines else False,
-                            })
-                            if not exclude and match.group(2) not in self.defines:
-                                exclude = True
-                                exclude_pos_start = match.start(1)
-                            pos = match.end(2)
-                    # Preprocessor else
-                    if not match:
-                        pattern = re.compile(r'(`else)[^a-zA-Z0-9_$]')
-                        match = pattern.match(content, match_start)
-                        if match:
-                            if not exclude:
-                                self.conditionals[-1]['equal'] = True
-                                self.conditionals[-1]['exclude'] = True
-                                exclude = True
-                                exclude_pos_start = match.end(1)
-                            elif exclude and self.conditionals[-1]['exclude']:
-                                self.conditionals[-1]['equal'] = not self.conditionals[-1]['equal']
-                                self.conditionals[-1]['exclude'] = False
-                                exclude = False
-                                exclude_pos_end = match.start(1)
-                                regions.append(sublime.Region(exclude_pos_start, exclude_pos_end))
-                            pos = match.end(1)
-                    # Preprocessor end
-                    if not match:
-                        pattern = re.compile(r'(`endif)[^a-zA-Z0-9_$]')
-                        match = pattern.match(content, match_start)
-                        if match:
-                            if exclude and self.conditionals[-1]['exclude']:
-                                exclude = False
-                                exclude_pos_end = match.end(1)
-                                regions.append(sublime.Region(exclude_pos_start, exclude_pos_end))
-                            del self.conditionals[-1]
-                            pos = match.end(1)
-                    # Preprocessor if not
-                    if not match:
-                        pattern = re.compile(r'(`ifndef)\s+([a-zA-Z_][a-zA-Z0-9_$]*)')
-                        match = pattern.match(content, match_start)
-                        if match:
-                            self.conditionals.append({
-                                'equal': True if match.group(2) not in self.defines else False,
-                                'exclude': True if not exclude and match.group(2) in self.defines else False,
-                            })
-                            if not exclude and match.group(2) in self.defines:
-                                exclude = True
-                                exclude_pos_start = match.start(1)
-                            pos = match.end(2)
-                    if not match:
-                        pos = match_end
+        match = next(tokens, None)
+        while match:
+            # Skip tokens inside comments and strings
+            if match.start() < pos:
+                # Token crosses end of comment or string, continue with lazy scan from its end, so remaining content
+                # is not extracted again on every crossing
+                if match.end() > pos:
+                    tokens = tokens_finditer(content, pos)
+                match = next(tokens, None)
+                continue
+            # Stop when no preprocessor directive is left
+            if match.start() > next_tick:
+                next_tick = content_find(b'`', match.start())
+                if next_tick == -1:
+                    break
+            token = match.lastgroup
+            # Single line comment
+            if token == 'line_comment':
+                end = content_find(b'\n', match.end())
+                if end != -1:
+                    pos = end + 1
+                else:
+                    pos = len(content)
+                    print('HDL_Syntax: Signle line comment is not ended with `newline`.')
+            # Multi line comment
+            elif token == 'block_comment':
+                end = content_find(b'*/', match.end())
+                if end != -1:
+                    pos = end + 2
                 else:
-                    pos = match_end
-            else:
-                pos = len(content)
-            if pos == last_pos:
-                print(f"HDL_Syntax: Internal error at position {pos}.")
-                pos += 1
+                    pos = len(content)
+                    print('HDL_Syntax: Multi line comment is not ended with `*/`.')
+            # String
+            elif token == 'string':
+                end = content_find(b'"', match.end())
+                while end != -1 and content[end - 1:end] == b'\\':
+                    end = content_find(b'"', end + 1)
+                if end != -1:
+                    pos = end + 1
+                else:
+                    pos = len(content)
+                    print('HDL_Syntax: String is not ended with `"`.')
+            # Include
+            elif token == 'include':
+                include_name = match.group('include_name').decode('utf-8', errors='replace')
+                self.preproc_include(include_name, cur_dir, incdirs)
+            # Define
+            elif token == 'define':
+                defines.add(match.group('define_name'))
+            # Undefine
+            elif token == 'undef':
+                defines.discard(match.group('undef_name'))
+            # Reset all defines
+            elif token == 'resetall':
+                defines.clear()
+            # Preprocessor if
+            elif token == 'ifdef':
+                cond_equal.append(True if match.group('ifdef_name') in defines else False)
+                cond_exclude.append(
+                    True if not exclude and match.group('ifdef_name') not in defines else False
+                )
+                if not exclude and match.group('ifdef_name') not in defines:
+                    exclude = True
+                    exclude_pos_start = match.start()
+            # Preprocessor else
+            elif token == 'else':
+                if not exclude:
+                    cond_equal[-1] = True
+                    cond_exclude[-1] = True
+                    exclude = True
+                    exclude_pos_start = match.end()
+                elif exclude and cond_exclude[-1]:
+                    cond_equal[-1] = not cond_equal[-1]
+                    cond_exclude[-1] = False
+                    exclude = False
+                    exclude_pos_end = match.start()
+                    add_region(regions, exclude_pos_start, exclude_pos_end)
+            # Preprocessor end
+            elif token == 'endif':
+                if exclude and cond_exclude[-1]:
+                    exclude = False
+                    exclude_pos_end = match.end()
+                    add_region(regions, exclude_pos_start, exclude_pos_end)
+                del cond_equal[-1]
+                del cond_exclude[-1]
+            # Preprocessor if not
+            elif token == 'ifndef':
+                cond_equal.append(True if match.group('ifndef_name') not in defines else False)
+                cond_exclude.append(
+                    True if not exclude and match.group('ifndef_name') in defines else False
+                )
+                if not exclude and match.group('ifndef_name') in defines:
+                    exclude = True
+                    exclude_pos_start = match.start()
+            match = next(tokens, None)
         return regions
 
+    def add_region(self, regions, start, end):
+        '''Add region to list, merging it with previous region when they touch or overlap
+
+        :param regions: Ascending regions
+        :type regions: list of (int, int)
+        :param start: Region start
+        :type start: int
+        :param end: Region end
+        :type end: int
+        '''
+        if regions and start <= regions[-1][1]:
+            regions[-1] = (regions[-1][0], max(regions[-1][1], end))
+        else:
+            regions.append((start, end))
+
+    def get_char_regions(self, content, regions):
+        '''Convert regions from UTF-8 byte offsets to character offsets
+
+        :param content: File content
+        :type content: bytes
+        :param regions: Ascending regions with offsets in bytes
+        :type regions: list of (int, int)
+        :return regions (offsets in characters)
+        :rtype: list of (int, int)
+        '''
+        byte_pos = 0
+        char_pos = 0
+        char_regions = []
+        for region in regions:
+            points = []
+            for point in region:
+                char_pos += len(content[byte_pos:point].decode('utf-8', errors='replace'))
+                byte_pos = point
+                points.append(char_pos)
+            char_regions.append(tuple(points))
+        return char_regions
+
+    def resolve_include(self, include_name, cur_dir, incdirs):
+        '''Returns path of included file. Searches directory of including file first, then `incdirs`.
+
+        :param include_name: File name used in `include directive
+        :type include_name: str
+        :param cur_dir: Directory of including file
+        :type cur_dir: str
+        :param incdirs: Directories searched for included files
+        :type incdirs: list of str
+        :return Included file path or None if file is not found
+        :rtype: str
+        '''
+        # Forget resolved paths when settings were reloaded
+        if incdirs is not self.resolve_incdirs:
+            self.resolve_incdirs = incdirs
+            self._resolve_cache.clear()
+        key = (cur_dir, include_name)
+        if key not in self._resolve_cache:
+            self._resolve_cache[key] = self.find_include(include_name, cur_dir, incdirs)
+        return self._resolve_cache[key]
+
+    def find_include(self, include_name, cur_dir, incdirs):
+        '''Search file system for included file. Searches directory of including file first, then `incdirs`.
+
+        :param include_name: File name used in `include directive
+        :type include_name: str
+        :param cur_dir: Directory of including file
+        :type cur_dir: str
+        :param incdirs: Directories searched for included files
+        :type incdirs: list of str
+        :return Included file path or None if file is not found
+        :rtype: str
+        '''
+        for incdir in [cur_dir] + incdirs:
+            file_name = os.path.join(incdir, include_name)
+            file_name = os.path.normpath(file_name)
+            if os.path.isfile(file_name):
+                return file_name
+        return None
+
+    def preproc_include(self, include_name, cur_dir, incdirs):
+        '''Preprocess included file content. Effects of an unchanged file on defines and conditionals are replayed
+        from cache instead of reading and parsing it again.
+
+        :param include_name: File name used in `include directive
+        :type include_name: str
+        :param cur_dir: Directory of including file
+        :type cur_dir: str
+        :param incdirs: Directories searched for included files
+        :type incdirs: list of str
+        '''
+        file_name = self.resolve_include(include_name, cur_dir, incdirs)
+        file_key = None if file_name is None else self.get_file_key(file_name)
+        # Record resolution, so cached results of including files notice when it changes
+        self.include_deps.append((cur_dir, include_name, file_name, file_key))
+        if file_name is None:
+            return
+        if file_key is None:
+            print(f"HDL_Syntax: Can\'t open `{file_name}` file.")
+            return
+        state = (
+            tuple(incdirs),
+            frozenset(self.defines),
+            tuple(self.cond_equal),
+            tuple(self.cond_exclude),
+        )
+        # Replay cached result
+        cached = self._include_cache.get(file_name)
+        if cached is not None and cached[0] == file_key and state in cached[1]:
+            defines, cond_equal, cond_exclude, deps = cached[1][state]
+            if all(self.is_dep_unchanged(dep, incdirs) for dep in deps):
+                self.defines.clear()
+                self.defines.update(defines)
+                self.cond_equal[:] = cond_equal
+                self.cond_exclude[:] = cond_exclude
+                self.include_deps += deps
+                return
+            # Resolved include paths may be outdated as well
+            self._resolve_cache.clear()
+        # Parse file
+        parent_deps = self.include_deps
+        self.include_deps = []
+        try:
+            with open(file_name, 'rb') as file:
+                include_content = file.read()
+            self.preproc(include_content, os.path.split(file_name)[0])
+        except OSError:
+            print(f"HDL_Syntax: Can\'t open `{file_name}` file.")
+        deps = self.include_deps
+        self.include_deps = parent_deps
+        self.include_deps += deps
+        # Store result
+        if cached is None or cached[0] != file_key or len(cached[1]) >= 64:
+            cached = (file_key, {})
+            self._include_cache[file_name] = cached
+        cached[1][state] = (
+            frozenset(self.defines),
+            tuple(self.cond_equal),
+            tuple(self.cond_exclude),
+            deps,
+        )
+
+    def is_dep_unchanged(self, dep, incdirs):
+        '''Check if nested include still resolves to the same, unchanged file
+
+        :param dep: Including directory, Include name, Included file path or None, File key or None
+        :type dep: (str, str, str, (int, int))
+        :param incdirs: Directories searched for included files
+        :type incdirs: list of str
+        :rtype: bool
+        '''
+        cur_dir, include_name, file_name, file_key = dep
+        if self.find_include(include_name, cur_dir, incdirs) != file_name:
+            return False
+        return file_name is None or self.get_file_key(file_name) == file_key
+
+    def get_file_key(self, file_name):
+        '''Returns data identifying file version
+
+        :param file_name: File path
+        :type file_name: str
+        :return (Modification time in nanoseconds, Size in bytes) or None if file is not accessible
+        :rtype: (int, int)
+        '''
+        try:
+            stat = os.stat(file_name)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
 
 class HDL_Preprocessor_settings:
     '''Handle HDL_Preprocessor settings
@@ -276,6 +450,7 @@ class HDL_Preprocessor_settings:
         '''Settings initialization
         '''
         self.settings = {}
+        self.incdirs_cache = None  # Validated and normalized `incdirs`
 
     def reload(self, view):
         '''Reload settings from file
@@ -283,15 +458,16 @@ class HDL_Preprocessor_settings:
         # Reload user settings
         self.settings = sublime.load_settings('HDL_Syntax.sublime-settings')
         self.settings = self.settings.to_dict()
+        self.incdirs_cache = None
         # Reload project settings
         project_data = view.window().project_data()
-        if project_data is not None and type(project_data) == dict:
+        if isinstance(project_data, dict):
             settings = project_data.get('settings')
-            if settings is not None and type(settings) == dict:
+            if isinstance(settings, dict):
                 for key, value in settings.items():
                     if key.startswith('HDL_Syntax_') or key == 'HDL_Linter_incdirs':
                         key = key[11:]
-                        if type(self.settings.get(key)) == list:
+                        if isinstance(self.settings.get(key), list):
                             self.settings[key] += value
                         else:
                             self.settings[key] = value
@@ -302,7 +478,7 @@ class HDL_Preprocessor_settings:
         # Get setting
         setting = self.settings.get('delay')
         # Possible values: int, float
-        if type(setting) == float or type(setting) == int:
+        if isinstance(setting, (float, int)) and not isinstance(setting, bool):
             return setting
         # Default value: 0.1
         setting = 0.1
@@ -312,19 +488,24 @@ class HDL_Preprocessor_settings:
     def incdirs(self):
         '''Specify directories to be searched for files included using Verilog `include
         '''
+        # Get setting validated since last reload
+        if self.incdirs_cache is not None:
+            return self.incdirs_cache
         # Get setting
         setting = self.settings.get('incdirs')
         # Possible values: list of "<path>"
-        if type(setting) == list:
-            copy = setting[:]
-            for path in reversed(copy):
-                if type(path) != str or not os.path.isdir(path):
+        if isinstance(setting, list):
+            self.incdirs_cache = []
+            for path in setting:
+                if isinstance(path, str) and os.path.isdir(path):
+                    self.incdirs_cache.append(os.path.normpath(path))
+                else:
                     print(f"HDL_Syntax: path `{path}` removed from `incdirs`")
-                    setting.remove(path)
-            return setting
+            return self.incdirs_cache
         # Default value: []
         setting = []
         print(f"HDL_Syntax: `incdirs` changed to default value `[]`")
+        self.incdirs_cache = setting
         return setting
 
 